@@ -1,39 +1,77 @@
 import argparse
 import contextlib
+import json
 import logging
+import math
 import os
 import shutil
 import sqlite3
 import sys
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from dataclasses import dataclass
 from dataclasses import field
 from pathlib import PurePath
 from sqlite3 import Connection
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Set
 from typing import Tuple
 from typing import Union
 
 import yaml
 from plexapi.exceptions import NotFound
+from plexapi.library import LibrarySection
 from plexapi.server import PlexServer
 from plexapi.video import Movie
 from plexapi.video import Show
 from plexapi.video import Video
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 PathLike = Union[PurePath, os.PathLike]
+# rel_path => scandir entry
+Tree = Dict[str, os.DirEntry]
 
 logger = logging.getLogger("refresh_plex")
 
 CACHE_DB = "cache.db"
+CACHE_VERSION = 2
+# removed directories are moved here, inside lib.dest so it is one filesystem
+TRASH_DIR = ".plex-refresh-trash"
+# the cache is disposable, so durability is traded for speed. mmap_size lets
+# lookups read the db pages straight from the page cache
+DB_PRAGMAS = [
+    "journal_mode = WAL",
+    "synchronous = NORMAL",
+    "cache_size = -65536",
+    "temp_store = MEMORY",
+    "mmap_size = 268435456",
+]
+FETCH_BATCH_SIZE = 100
+# above this many directories a full library scan is cheaper
+MAX_PARTIAL_SCANS = 20
+SCAN_WORKERS = min(32, 4 * (os.cpu_count() or 1))
+# parallel readdir on one disk stops scaling at a few threads and then gets
+# slower, so each device gets its own small pool instead of sharing one
+DEVICE_SCAN_WORKERS = 4
+USE_DIR_FDS = {os.link, os.mkdir, os.unlink} <= os.supports_dir_fd
 
 
 @dataclass
 class PlexLibrary:
     type: str
-    src: PathLike
-    dest: PathLike
+    src: str
+    dest: str
 
 
 @dataclass
@@ -45,8 +83,8 @@ class PlexHost:
 
 @dataclass
 class SyncMetric:
-    dirs: List[PathLike] = field(default_factory=list)
-    files: List[PathLike] = field(default_factory=list)
+    dirs: List[str] = field(default_factory=list)
+    files: List[str] = field(default_factory=list)
 
     def has_values(self):
         return bool(self.dirs or self.files)
@@ -57,6 +95,8 @@ class LibMetrics:
     added: SyncMetric = field(default_factory=SyncMetric)
     removed: SyncMetric = field(default_factory=SyncMetric)
     changed: SyncMetric = field(default_factory=SyncMetric)
+    # dest directories whose entries were added or removed
+    refresh_dirs: Set[str] = field(default_factory=set)
 
     def __str__(self):
         sb = list()
@@ -67,6 +107,42 @@ class LibMetrics:
         return "\n".join(sb)
 
 
+class DirFds:
+    """
+    keeps the directories under root open, so link/unlink/mkdir only need the
+    kernel to resolve the final path component instead of the whole path
+    """
+
+    def __init__(self, root: PathLike, max_open: int = 64):
+        self.root = root
+        self.max_open = max_open
+        self._fds: Dict[str, int] = {}
+
+    def resolve(self, rel_path: str) -> Tuple[str, Optional[int]]:
+        """returns the (path, dir_fd) pair to pass to the os functions"""
+        if not USE_DIR_FDS:
+            return os.path.join(self.root, rel_path), None
+        rel_dir, name = os.path.split(rel_path)
+        fd = self._fds.get(rel_dir)
+        if fd is None:
+            if len(self._fds) >= self.max_open:
+                os.close(self._fds.pop(next(iter(self._fds))))
+            fd = os.open(os.path.join(self.root, rel_dir), os.O_RDONLY | os.O_DIRECTORY)
+            self._fds[rel_dir] = fd
+        return name, fd
+
+    def close(self):
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 class Config:
     def __init__(self, parsed_args):
         self.config_file: PathLike = PurePath(parsed_args.config)
@@ -80,22 +156,40 @@ class Config:
 
     def parse_config_file(self):
         with open(self.config_file) as fp:
-            config_dict = yaml.safe_load(fp)
-        for lib_dict in config_dict["libs"]:
-            lib = PlexLibrary(
-                lib_dict["type"], PurePath(lib_dict["src"]), PurePath(lib_dict["dest"])
+            # json is a subset of yaml, but the stdlib parser is much cheaper
+            if self.config_file.suffix == ".json":
+                config_dict = json.load(fp)
+            else:
+                config_dict = yaml.load(fp, Loader=SafeLoader)
+        # normalized once here, the sync hot path joins onto plain strings
+        libs = [
+            PlexLibrary(
+                lib_dict["type"],
+                str(PurePath(lib_dict["src"])),
+                str(PurePath(lib_dict["dest"])),
             )
+            for lib_dict in config_dict["libs"]
+        ]
+        # the roots may be on slow network mounts, so they are checked concurrently
+        roots = {root for lib in libs for root in (lib.src, lib.dest)}
+        with ThreadPoolExecutor(
+            max_workers=min(SCAN_WORKERS, len(roots)) or 1
+        ) as executor:
+            root_errors = dict(zip(roots, executor.map(stat_error, roots)))
+        for lib in libs:
             is_valid = True
             logger.debug(lib)
             if lib.type not in ["movie", "show"]:
                 is_valid = False
                 logger.error("lib type must be movie or show")
-            if not os.path.exists(lib.src):
-                is_valid = False
-                logger.error(f"lib src is missing: {lib.src}")
-            if not os.path.exists(lib.dest):
-                is_valid = False
-                logger.error(f"lib dest is missing: {lib.dest}")
+            for name, root in [("src", lib.src), ("dest", lib.dest)]:
+                error = root_errors[root]
+                if isinstance(error, FileNotFoundError):
+                    is_valid = False
+                    logger.error("lib %s is missing: %s", name, root)
+                elif error is not None:
+                    is_valid = False
+                    logger.error("lib %s is not accessible: %s [%s]", name, root, error)
             if is_valid:
                 self.plex_libs.append(lib)
         plex_dict = config_dict.get("plex")
@@ -113,86 +207,134 @@ class Plex:
             f"http://{self.config.plex.host}:{self.config.plex.port}",
             self.config.plex.token,
         )
-        for lib in self.plex.library.sections():
-            logger.debug(f"Plex library: {lib.title} [{lib.type}]")
+        self._item_cache: Dict[int, Video] = {}
+        self._trash_cleanup: Optional[threading.Thread] = None
+        # sections don't change during a run, so they are only fetched once
+        self.sections: List[LibrarySection] = self.plex.library.sections()
+        for lib in self.sections:
+            logger.debug("Plex library: %s [%s]", lib.title, lib.type)
+
+    def remove_media(
+        self, lib: PlexLibrary, rel_path: str, is_dir: bool, dest_fds: DirFds
+    ) -> str:
+        dest_path = os.path.join(lib.dest, rel_path)
+        src_path = os.path.join(lib.src, rel_path)
+        if is_dir:
+            if not self.config.dry_run:
+                # a rename is a single syscall on the same filesystem, the
+                # actual delete happens in the background in empty_trash
+                trash_dir = os.path.join(lib.dest, TRASH_DIR)
+                os.makedirs(trash_dir, exist_ok=True)
+                os.rename(dest_path, os.path.join(trash_dir, uuid.uuid4().hex))
+            logger.info("Directory removed: %s", src_path)
+        else:
+            if not self.config.dry_run:
+                dest_name, dest_dir_fd = dest_fds.resolve(rel_path)
+                os.unlink(dest_name, dir_fd=dest_dir_fd)
+            logger.info("File removed: %s", src_path)
+        return rel_path
 
-    def check_removed_media(
+    def add_media(
         self,
-        root: str,
-        name: str,
-        lib_src: PathLike,
-        lib_dest: PathLike,
-        is_dirs: bool,
-    ) -> Optional[PathLike]:
-        dest_path: PathLike = PurePath(root).joinpath(name)
-        rel_path: PathLike = dest_path.relative_to(lib_dest)
-        src_path: PathLike = lib_src.joinpath(rel_path)
-
-        logger.debug(f"checking if {dest_path} is removed")
-
-        if not os.path.exists(src_path):
-            if is_dirs:
-                if not self.config.dry_run:
-                    shutil.rmtree(dest_path, ignore_errors=True)
-                logger.info(f"Directory removed: {src_path}")
-            else:
-                if not self.config.dry_run:
-                    os.remove(dest_path)
-                logger.info(f"File removed: {src_path}")
-            return rel_path
+        lib: PlexLibrary,
+        rel_path: str,
+        is_dir: bool,
+        src_fds: DirFds,
+        dest_fds: DirFds,
+    ) -> str:
+        src_path = os.path.join(lib.src, rel_path)
+        dest_path = os.path.join(lib.dest, rel_path)
+        if is_dir:
+            if not self.config.dry_run:
+                dest_name, dest_dir_fd = dest_fds.resolve(rel_path)
+                os.mkdir(dest_name, dir_fd=dest_dir_fd)
+            logger.info("Directory created: %s", dest_path)
+        else:
+            if not self.config.dry_run:
+                link(rel_path, src_fds, dest_fds)
+            logger.info("Hardlink created: %s", src_path)
+        return rel_path
 
-    def check_added_media(
+    def change_media(
         self,
-        root: str,
-        name: str,
-        lib_src: PathLike,
-        lib_dest: PathLike,
-        is_dirs,
-    ) -> Optional[PathLike]:
-        src_path: PathLike = PurePath(root).joinpath(name)
-        rel_path: PathLike = src_path.relative_to(lib_src)
-        dest_path: PathLike = lib_dest.joinpath(rel_path)
-
-        logger.debug(f"checking if {src_path} is added")
-
-        if not os.path.exists(dest_path):
-            if is_dirs:
-                if not self.config.dry_run:
-                    os.mkdir(dest_path)
-                logger.info(f"Directory created: {dest_path}")
-            else:
-                if not self.config.dry_run:
-                    os.link(src_path, dest_path)
-                logger.info(f"Hardlink created: {src_path}")
-            return rel_path
+        lib: PlexLibrary,
+        rel_path: str,
+        src_size: int,
+        dest_size: int,
+        src_fds: DirFds,
+        dest_fds: DirFds,
+    ) -> str:
+        src_path = os.path.join(lib.src, rel_path)
+        if not self.config.dry_run:
+            dest_name, dest_dir_fd = dest_fds.resolve(rel_path)
+            os.unlink(dest_name, dir_fd=dest_dir_fd)
+            link(rel_path, src_fds, dest_fds)
+        logger.info(
+            "Refreshed hardlink: %s [%s => %s]",
+            src_path,
+            sizeof_fmt(dest_size),
+            sizeof_fmt(src_size),
+        )
+        return rel_path
 
-    def check_changed_media(
+    def sync_library(
         self,
-        root: str,
-        name: str,
-        lib_src: PathLike,
-        lib_dest: PathLike,
-        is_dirs: bool,
-    ) -> Optional[PathLike]:
-        if is_dirs:
-            return None
-
-        dest_path: PathLike = PurePath(root).joinpath(name)
-        rel_path: PathLike = dest_path.relative_to(lib_dest)
-        src_path: PathLike = lib_src.joinpath(rel_path)
-
-        logger.debug(f"checking if {dest_path} has changed")
-
-        src_size = os.path.getsize(src_path)
-        dest_size = os.path.getsize(dest_path)
-        if src_size != dest_size:
-            if not self.config.dry_run:
-                os.remove(dest_path)
-                os.link(src_path, dest_path)
-            logger.info(
-                f"Refreshed hardlink: {src_path} [{sizeof_fmt(dest_size)} => {sizeof_fmt(src_size)}]"
-            )
-            return rel_path
+        lib: PlexLibrary,
+        src_tree: Tree,
+        dest_tree: Tree,
+        lib_metrics: LibMetrics,
+    ):
+        with DirFds(lib.src) as src_fds, DirFds(lib.dest) as dest_fds:
+            # subtrees of removed directories are never scanned, the whole
+            # directory is moved into the trash dir in one rename
+            for rel_path in sorted(dest_tree.keys() - src_tree.keys()):
+                is_dir = dest_tree[rel_path].is_dir(follow_symlinks=False)
+                path = self.remove_media(lib, rel_path, is_dir, dest_fds)
+                lib_metrics.refresh_dirs.add(
+                    os.path.dirname(os.path.join(lib.dest, path))
+                )
+                if is_dir:
+                    lib_metrics.removed.dirs.append(path)
+                else:
+                    lib_metrics.removed.files.append(path)
+
+            for rel_path in sorted(src_tree.keys() & dest_tree.keys()):
+                src_entry, dest_entry = src_tree[rel_path], dest_tree[rel_path]
+                if src_entry.is_dir() or dest_entry.is_dir(follow_symlinks=False):
+                    continue
+                # readdir already reports the inode, so files that are still
+                # hardlinked to their source never need a stat
+                if src_entry.inode() == dest_entry.inode():
+                    continue
+                # d_ino is not st_ino on every filesystem, so confirm with a stat.
+                # a different inode means the source was replaced, even if the
+                # size happens to match. os.link follows symlinks, so the src
+                # stat has to as well
+                src_stat = src_entry.stat()
+                dest_stat = dest_entry.stat(follow_symlinks=False)
+                if os.path.samestat(src_stat, dest_stat):
+                    continue
+                path = self.change_media(
+                    lib,
+                    rel_path,
+                    src_stat.st_size,
+                    dest_stat.st_size,
+                    src_fds,
+                    dest_fds,
+                )
+                lib_metrics.changed.files.append(path)
+
+            # sorting guarantees parent directories are created before children
+            for rel_path in sorted(src_tree.keys() - dest_tree.keys()):
+                is_dir = src_tree[rel_path].is_dir()
+                path = self.add_media(lib, rel_path, is_dir, src_fds, dest_fds)
+                lib_metrics.refresh_dirs.add(
+                    os.path.dirname(os.path.join(lib.dest, path))
+                )
+                if is_dir:
+                    lib_metrics.added.dirs.append(path)
+                else:
+                    lib_metrics.added.files.append(path)
 
     def sync(self) -> Optional[Dict[str, LibMetrics]]:
         if not self.config.plex_libs:
@@ -203,118 +345,179 @@ class Plex:
 
         metrics: Dict[str, LibMetrics] = dict()
 
-        for lib in self.config.plex_libs:
+        # scanning is read-only so every tree is read up front in parallel,
+        # modifications are then applied serially per library
+        for lib, (src_tree, dest_tree) in zip(
+            self.config.plex_libs, read_trees(self.config.plex_libs)
+        ):
             lib_metrics = metrics.setdefault(lib.type, LibMetrics())
-
-            for root, dirs, files in os.walk(lib.dest):
-                for dir in sorted(dirs):
-                    if path := self.check_removed_media(
-                        root, dir, lib.src, lib.dest, True
-                    ):
-                        dirs.remove(dir)
-                        lib_metrics.removed.dirs.append(path)
-                for file in sorted(files):
-                    if path := self.check_removed_media(
-                        root, file, lib.src, lib.dest, False
-                    ):
-                        lib_metrics.removed.files.append(path)
-                    elif path := self.check_changed_media(
-                        root, file, lib.src, lib.dest, False
-                    ):
-                        lib_metrics.changed.files.append(path)
-
-            for root, dirs, files in os.walk(lib.src):
-                for dir in sorted(dirs):
-                    if path := self.check_added_media(
-                        root, dir, lib.src, lib.dest, True
-                    ):
-                        lib_metrics.added.dirs.append(path)
-                for file in sorted(files):
-                    if path := self.check_added_media(
-                        root, file, lib.src, lib.dest, False
-                    ):
-                        lib_metrics.added.files.append(path)
+            self.sync_library(lib, src_tree, dest_tree, lib_metrics)
 
         for lib_type, lib_metrics in metrics.items():
-            logger.info(f"\n{lib_type} metrics:\n{lib_metrics}")
+            logger.info("\n%s metrics:\n%s", lib_type, lib_metrics)
+
+        self.empty_trash()
 
         return metrics
 
-    def refresh_libraries(self):
+    def empty_trash(self):
+        """deletes trashed directories in a background thread, see wait_for_trash"""
+        # leftovers from an interrupted run are kept too, dry runs never delete
+        if self.config.dry_run:
+            return
+
+        trash_dirs = [
+            trash_dir
+            for trash_dir in (
+                os.path.join(lib.dest, TRASH_DIR) for lib in self.config.plex_libs
+            )
+            if os.path.isdir(trash_dir)
+        ]
+        if not trash_dirs:
+            return
+
+        def delete():
+            for trash_dir in trash_dirs:
+                shutil.rmtree(trash_dir, ignore_errors=True)
+
+        self._trash_cleanup = threading.Thread(target=delete, name="empty-trash")
+        self._trash_cleanup.start()
+
+    def wait_for_trash(self):
+        if self._trash_cleanup is not None:
+            self._trash_cleanup.join()
+
+    def refresh_libraries(self, refresh_dirs: Set[str]):
         if self.config.skip_refresh:
             logger.warning("Skipping refresh...")
             return
 
-        if not self.config.dry_run:
-            self.plex.library.update()
+        # only the top-most directories need a scan, plex scans them recursively
+        scan_dirs = sorted(
+            path
+            for path in refresh_dirs
+            if not any(parent in refresh_dirs for parent in parent_dirs(path))
+        )
+        partial_scans = [
+            (find_section(self.sections, path), path) for path in scan_dirs
+        ]
+        if len(partial_scans) > MAX_PARTIAL_SCANS or any(
+            section is None for section, _ in partial_scans
+        ):
+            if not self.config.dry_run:
+                self.plex.library.update()
+            logger.info("Refresh media triggered")
+            return
 
-        logger.info("Refresh media triggered")
+        for section, path in partial_scans:
+            if not self.config.dry_run:
+                section.update(path=path)
+            logger.info("Refresh media triggered for %s [%s]", path, section.title)
+
+    def cache_rows(self) -> Iterator[Tuple[str, int, str, Optional[str], str]]:
+        for lib_section in self.sections:
+            lib_type = lib_section.type
+            if lib_type not in ["movie", "show"]:
+                continue
+            locations = [str(PurePath(loc)) for loc in lib_section.locations]
+            for item in lib_section.all("movie" if lib_type == "movie" else "episode"):
+                self._item_cache[item.ratingKey] = item
+                for file in [mp.file for m in item.media for mp in m.parts]:
+                    yield (
+                        lib_type,
+                        item.ratingKey,
+                        file,
+                        relative_to_any(file, locations),
+                        file[::-1],
+                    )
 
     def refresh_cache(self):
         logger.info("Refreshing cache...")
         with open_db(CACHE_DB, reset=True) as conn:
-            data: List[Tuple[str, int, str]] = []
-            for lib_section in self.plex.library.sections():
-                lib_type = lib_section.type
-                if lib_type not in ["movie", "show"]:
-                    continue
-                for item in lib_section.all(
-                    "movie" if lib_type == "movie" else "episode"
-                ):
-                    for file in [mp.file for m in item.media for mp in m.parts]:
-                        data.append((lib_type, item.ratingKey, str(PurePath(file))))
-            conn.executemany("INSERT INTO media VALUES (?, ?, ?)", data)
+            conn.execute("BEGIN")
+            # rows are pulled lazily, so inserts overlap with fetching sections
+            conn.executemany(
+                "INSERT INTO media VALUES (?, ?, ?, ?, ?)", self.cache_rows()
+            )
             conn.commit()
+            conn.execute("ANALYZE media")
 
     def is_plex_media_valid(
         self, item: Union[Movie, Show], expected_media_path: str
     ) -> bool:
         for media_part in [mp for m in item.media for mp in m.parts]:
-            if PurePath(media_part.file) == PurePath(expected_media_path):
+            if media_part.file == expected_media_path:
                 return True
         return False
 
+    def fetch_items(self, keys: Iterable[int]) -> Dict[int, Video]:
+        """
+        fetches the items for the rating keys, FETCH_BATCH_SIZE keys per request.
+        items already seen by refresh_cache or an earlier call are not refetched
+        """
+        items: Dict[int, Video] = {}
+        missing_keys = []
+        for key in sorted(keys):
+            if key in self._item_cache:
+                items[key] = self._item_cache[key]
+            else:
+                missing_keys.append(key)
+        for i in range(0, len(missing_keys), FETCH_BATCH_SIZE):
+            batch = missing_keys[i : i + FETCH_BATCH_SIZE]
+            try:
+                fetched = self.plex.fetchItems(
+                    f"/library/metadata/{','.join(str(key) for key in batch)}"
+                )
+            except NotFound:
+                continue
+            for item in fetched:
+                items[item.ratingKey] = self._item_cache[item.ratingKey] = item
+        return items
+
     def find_items(
-        self, changed_paths: Dict[str, List[PathLike]], verify: bool
-    ) -> Optional[Tuple[Dict[str, Video], Dict[str, List[PathLike]]]]:
-        analyze_items: Dict[str, Video] = {}
-        missing_items: Dict[str, List[PathLike]] = {}
+        self, changed_paths: Dict[str, List[str]], verify: bool
+    ) -> Optional[Tuple[Dict[int, Video], Dict[str, List[str]]]]:
+        analyze_items: Dict[int, Video] = {}
+        missing_items: Dict[str, List[str]] = {}
 
         with open_db(CACHE_DB) as conn:
             cur = conn.cursor()
-            stmt = "SELECT * FROM media WHERE lib = ? AND path LIKE ?"
-            for lib_type, lib_changed_paths in changed_paths.items():
-                for relative_path in lib_changed_paths:
-                    is_valid = False
-                    for lib, key, media_path in cur.execute(
-                        stmt, (lib_type, f"%{relative_path}")
-                    ):
-                        if key in analyze_items:
-                            is_valid = True
-                            continue
-                        try:
-                            item: Union[Movie, Show] = self.plex.library.fetchItem(
-                                int(key)
-                            )
-                            if verify and not self.is_plex_media_valid(
-                                item, media_path
-                            ):
-                                return None
-                            is_valid = True
-                            analyze_items[key] = item
-                            continue
-                        except (NotFound, AttributeError):
-                            if verify:
-                                return None
-                    if not is_valid:
-                        if verify:
+            matches = [
+                (lib_type, relative_path, lookup_media(cur, lib_type, relative_path))
+                for lib_type, lib_changed_paths in changed_paths.items()
+                for relative_path in lib_changed_paths
+            ]
+
+        items = self.fetch_items({key for _, _, rows in matches for key, _ in rows})
+
+        for lib_type, relative_path, rows in matches:
+            is_valid = False
+            for key, media_path in rows:
+                if key in analyze_items:
+                    is_valid = True
+                    continue
+                item: Optional[Union[Movie, Show]] = items.get(key)
+                if item is None:
+                    if verify:
+                        return None
+                    continue
+                if verify:
+                    try:
+                        if not self.is_plex_media_valid(item, media_path):
                             return None
-                        else:
-                            missing_items.setdefault(lib_type, []).append(relative_path)
+                    except AttributeError:
+                        return None
+                is_valid = True
+                analyze_items[key] = item
+            if not is_valid:
+                if verify:
+                    return None
+                else:
+                    missing_items.setdefault(lib_type, []).append(relative_path)
 
         return analyze_items, missing_items
 
-    def analyze_libraries(self, changed_paths: Dict[str, List[PathLike]]):
+    def analyze_libraries(self, changed_paths: Dict[str, List[str]]):
         if self.config.skip_analyze:
             logger.warning("Skipping analyze...")
             return
@@ -333,13 +536,13 @@ class Plex:
         for video in analyze_items.values():
             if not self.config.dry_run:
                 video.analyze()
-            logger.info(f"Triggered analyze for {video}")
+            logger.info("Triggered analyze for %s", video)
 
         for lib_type, paths in missing_items.items():
             lib_path = PurePath(f"[{lib_type}]")
             for rel_path in paths:
                 fake_path = lib_path.joinpath(rel_path)
-                logger.warning(f"Analyzed skipped for {fake_path}")
+                logger.warning("Analyzed skipped for %s", fake_path)
 
     def update_server(self, metrics: Dict[str, LibMetrics]):
         if not metrics:
@@ -357,15 +560,135 @@ class Plex:
             lib_metrics.added.has_values() or lib_metrics.removed.has_values()
             for lib_metrics in metrics.values()
         ):
-            self.refresh_libraries()
+            self.refresh_libraries(
+                set().union(
+                    *(lib_metrics.refresh_dirs for lib_metrics in metrics.values())
+                )
+            )
 
 
 def sizeof_fmt(num, suffix="B"):
-    for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]:
-        if abs(num) < 1024.0:
-            return f"{num:3.1f}{unit}{suffix}"
-        num /= 1024.0
-    return f"{num:.1f}Yi{suffix}"
+    units = ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]
+    idx = 0 if abs(num) < 1024 else min(len(units), int(math.log2(abs(num))) // 10)
+    # log2 rounds up for values just below a power of 1024
+    if idx and abs(num) / 1024.0**idx < 1:
+        idx -= 1
+    if idx >= len(units):
+        return f"{num / 1024.0 ** len(units):.1f}Yi{suffix}"
+    return f"{num / 1024.0**idx:3.1f}{units[idx]}{suffix}"
+
+
+def stat_error(path: str) -> Optional[OSError]:
+    try:
+        os.stat(path)
+    except OSError as e:
+        return e
+    return None
+
+
+def link(rel_path: str, src_fds: DirFds, dest_fds: DirFds):
+    src_name, src_dir_fd = src_fds.resolve(rel_path)
+    dest_name, dest_dir_fd = dest_fds.resolve(rel_path)
+    os.link(src_name, dest_name, src_dir_fd=src_dir_fd, dst_dir_fd=dest_dir_fd)
+
+
+def device_of(path: str) -> int:
+    return os.stat(path).st_dev
+
+
+def scan_dir(root: PathLike, rel_dir: str) -> Optional[List[Tuple[str, os.DirEntry]]]:
+    """
+    returns (rel_path, entry) for every entry directly under rel_dir, or None if
+    the directory can't be listed
+    """
+    path = os.path.join(root, rel_dir)
+    try:
+        with os.scandir(path) as it:
+            return [(os.path.join(rel_dir, entry.name), entry) for entry in it]
+    except OSError as e:
+        logger.warning("Skipping unreadable directory: %s [%s]", path, e)
+        return None
+
+
+def is_syncable(entry: os.DirEntry) -> bool:
+    """directories, files and symlinks to either, os.link can't link anything else"""
+    try:
+        if entry.is_dir() or entry.is_file():
+            return True
+    except OSError:
+        pass
+    logger.warning("Skipping unsupported entry: %s", entry.path)
+    return False
+
+
+def scan_dirs(
+    lib: PlexLibrary, rel_dir: str, in_dest: bool
+) -> Tuple[List[Tuple[str, os.DirEntry]], List[Tuple[str, os.DirEntry]]]:
+    src_entries = scan_dir(lib.src, rel_dir)
+    dest_entries = scan_dir(lib.dest, rel_dir) if in_dest else []
+    # if either side can't be listed its entries would look added or removed, so
+    # the whole directory is left alone until the next run
+    if src_entries is None or dest_entries is None:
+        return [], []
+    if not rel_dir:
+        dest_entries = [
+            (rel_path, entry)
+            for rel_path, entry in dest_entries
+            if rel_path != TRASH_DIR
+        ]
+    src_entries = [
+        (rel_path, entry) for rel_path, entry in src_entries if is_syncable(entry)
+    ]
+    return src_entries, dest_entries
+
+
+def read_trees(libs: List[PlexLibrary]) -> List[Tuple[Tree, Tree]]:
+    """
+    scans the src and dest trees of every library concurrently, one task per
+    directory and one pool per device. both sides are listed together, so
+    subtrees missing from src are never descended and subtrees missing from dest
+    are only read from src
+    """
+    trees: List[Tuple[Tree, Tree]] = [(dict(), dict()) for _ in libs]
+    with contextlib.ExitStack() as stack:
+        # src and dest are hardlinked, so they always share a device
+        executors: Dict[int, ThreadPoolExecutor] = {}
+        pending = {}
+        for lib, (src_tree, dest_tree) in zip(libs, trees):
+            device = device_of(lib.src)
+            if device not in executors:
+                executors[device] = stack.enter_context(
+                    ThreadPoolExecutor(max_workers=DEVICE_SCAN_WORKERS)
+                )
+            executor = executors[device]
+            pending[executor.submit(scan_dirs, lib, "", True)] = (
+                lib,
+                executor,
+                src_tree,
+                dest_tree,
+            )
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                lib, executor, src_tree, dest_tree = pending.pop(future)
+                src_entries, dest_entries = future.result()
+                dest_tree.update(dest_entries)
+                for rel_path, entry in src_entries:
+                    src_tree[rel_path] = entry
+                    # like os.walk, symlinked directories are mirrored as a
+                    # directory but never descended, so link cycles can't recurse
+                    if entry.is_dir(follow_symlinks=False):
+                        dest_entry = dest_tree.get(rel_path)
+                        in_dest = dest_entry is not None and dest_entry.is_dir(
+                            follow_symlinks=False
+                        )
+                        pending[executor.submit(scan_dirs, lib, rel_path, in_dest)] = (
+                            lib,
+                            executor,
+                            src_tree,
+                            dest_tree,
+                        )
+    return trees
 
 
 def parse_args(args_without_script) -> Config:
@@ -397,13 +720,70 @@ def parse_args(args_without_script) -> Config:
     return Config(parsed_args)
 
 
+def parent_dirs(path: str) -> Iterator[str]:
+    parent = os.path.dirname(path)
+    while parent != path:
+        yield parent
+        path, parent = parent, os.path.dirname(parent)
+
+
+def find_section(sections: List[LibrarySection], path: str) -> Optional[LibrarySection]:
+    for section in sections:
+        for location in section.locations:
+            location = str(PurePath(location))
+            if path == location or relative_to_any(path, [location]) is not None:
+                return section
+    return None
+
+
+def relative_to_any(path: str, roots: List[str]) -> Optional[str]:
+    for root in roots:
+        if path.startswith(root + os.sep):
+            return path[len(root) + 1 :]
+    return None
+
+
+def lookup_media(
+    cur: sqlite3.Cursor, lib_type: str, relative_path: str
+) -> List[Tuple[int, str]]:
+    """
+    finds the cached media for a library relative path. paths outside the known
+    section locations fall back to a suffix match, which is done as a range scan
+    over the reversed path so it can still use an index
+    """
+    rows = cur.execute(
+        "SELECT key, path FROM media WHERE lib = ? AND rel_path = ?",
+        (lib_type, relative_path),
+    ).fetchall()
+    if rows:
+        return rows
+    rev_path = relative_path[::-1]
+    return cur.execute(
+        "SELECT key, path FROM media WHERE lib = ? AND rev_path >= ? AND rev_path < ?",
+        (lib_type, rev_path, rev_path + "\U0010ffff"),
+    ).fetchall()
+
+
 @contextlib.contextmanager
 def open_db(db: str, reset: bool = False) -> Connection:
     conn = sqlite3.connect(db)
     try:
-        if reset:
+        for pragma in DB_PRAGMAS:
+            conn.execute(f"PRAGMA {pragma}")
+        (version,) = conn.execute("PRAGMA user_version").fetchone()
+        if reset or version != CACHE_VERSION:
             conn.execute("DROP TABLE IF EXISTS media")
-        conn.execute("CREATE TABLE IF NOT EXISTS media (lib TEXT, key INT, path TEXT)")
+            conn.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS media "
+            "(lib TEXT, key INT, path TEXT, rel_path TEXT, rev_path TEXT)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_media_lib_relpath ON media(lib, rel_path)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_media_lib_revpath ON media(lib, rev_path)"
+        )
         conn.commit()
         yield conn
     finally:
@@ -426,6 +806,7 @@ def run(*args_without_script: str):
     if config.refresh_cache:
         plex.refresh_cache()
     plex.update_server(metrics)
+    plex.wait_for_trash()
 
 
 if __name__ == "__main__":